@@ -1,8 +1,16 @@
 import asyncio
+import ctypes
+import errno
+import fcntl
 import logging
+import os
+import shutil
 import tempfile
+from collections import deque
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Optional
+from uuid import uuid4
 
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
@@ -11,173 +19,490 @@ from pydantic_settings import BaseSettings
 
 logger = logging.getLogger(__name__)
 
+# BWA's stdout is drained into 1 MiB buffers, each handed to a worker thread
+# as one write() once full (or once the pipe runs dry).
+SAM_PUMP_BUFFER = 1024 * 1024
+
+# Direct I/O needs block-aligned buffers, lengths and file offsets; 4 KiB
+# satisfies every common logical block size. Larger buffers amortise the
+# synchronous device round trip each O_DIRECT write makes.
+DIRECT_IO_ALIGN = 4096
+DIRECT_IO_BUFFER = 16 * 1024 * 1024
+O_DIRECT = getattr(os, "O_DIRECT", 0)
+
+# Linux pipes default to 64 KiB, which a multithreaded BWA fills long before
+# the reader wakes up, leaving BWA blocked in write(); pipes are grown to this.
+PIPE_SIZE = 1024 * 1024
+
+BWA_INDEX_SUFFIXES = ('.amb', '.ann', '.bwt', '.pac', '.sa')
+
+# Only this many trailing stderr lines are kept for error reports; BWA logs
+# every batch, which adds up to hundreds of MB over a large alignment.
+STDERR_TAIL_LINES = 2000
+
+
+def _count_sam_records(
+    chunk: bytes,
+    at_line_start: bool,
+    start: int = 0,
+    end: Optional[int] = None
+) -> int:
+    """Count SAM records (non-``@`` lines) terminated inside ``chunk[start:end]``.
+
+    ``at_line_start`` says whether the previous chunk ended on a newline, so
+    header lines split across chunk boundaries are still recognised.
+    """
+    headers = chunk.count(b"\n@", start, end)
+    if at_line_start and chunk[start:start + 1] == b"@":
+        headers += 1
+    return chunk.count(b"\n", start, end) - headers
+
+
+def _stat(path: Path) -> Optional[os.stat_result]:
+    """``os.stat`` that returns None for a missing path instead of raising."""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _parse_cpu_list(cpu_list: str) -> set[int]:
+    """Expand a taskset-style CPU list such as ``0-3,8,10-15:2``."""
+    cpus = set()
+    for part in cpu_list.split(","):
+        span, _, stride = part.strip().partition(":")
+        first, _, last = span.partition("-")
+        try:
+            cpus.update(range(int(first), int(last or first) + 1, int(stride or 1)))
+        except ValueError:
+            raise ValueError(f"Invalid CPU list: {cpu_list}") from None
+    return cpus
+
+
+def _available_cpus(cpu_list: Optional[str] = None) -> int:
+    """Count the CPUs BWA can actually run on.
+
+    That is this process's affinity mask, which reflects cgroup cpusets and
+    SLURM allocations where ``os.cpu_count()`` reports the whole host,
+    narrowed to the CPUs named in ``cpu_list`` when given. CPUs in the list
+    that are missing or outside the mask are not counted.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = os.sched_getaffinity(0)
+    else:
+        cpus = set(range(os.cpu_count() or 4))
+    if cpu_list:
+        cpus = cpus & _parse_cpu_list(cpu_list)
+    return len(cpus)
+
+
+def _missing_index_files(reference: Path) -> list[str]:
+    return [
+        suffix for suffix in BWA_INDEX_SUFFIXES
+        if _stat(reference.with_suffix(reference.suffix + suffix)) is None
+    ]
+
+
+def _format_count(count: Optional[int]) -> str:
+    return f"{count:,}" if count is not None else "(not counted)"
+
+
+async def _read_stderr_tail(stream: asyncio.StreamReader) -> bytes:
+    """Drain ``stream`` to EOF, returning only its last STDERR_TAIL_LINES lines."""
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # Line longer than the stream limit; readline() already dropped it
+            continue
+        if not line:
+            break
+        tail.append(line)
+    return b"".join(tail)
+
+
+async def _wait_readable(fd: int) -> None:
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    loop.add_reader(fd, lambda: waiter.done() or waiter.set_result(None))
+    try:
+        await waiter
+    finally:
+        loop.remove_reader(fd)
+
+
+def _make_pipe() -> tuple[int, int]:
+    read_fd, write_fd = os.pipe()
+    if hasattr(fcntl, "F_SETPIPE_SZ"):
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            # Above /proc/sys/fs/pipe-max-size for unprivileged users
+            pass
+    return read_fd, write_fd
+
+
+def _aligned_buffer(size: int) -> tuple[bytearray, int]:
+    """Allocate a buffer with ``size`` usable bytes starting at an aligned offset.
+
+    Returns the buffer and that offset.
+    """
+    buf = bytearray(size + DIRECT_IO_ALIGN)
+    address = ctypes.addressof(ctypes.c_char.from_buffer(buf))
+    return buf, -address % DIRECT_IO_ALIGN
+
+
+def _open_output(path: Path, direct: bool) -> int:
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if direct:
+        try:
+            return os.open(path, flags | O_DIRECT, 0o644)
+        except OSError as e:
+            # tmpfs and some network filesystems refuse O_DIRECT outright
+            if e.errno != errno.EINVAL:
+                raise
+            logger.info(f"Direct I/O not supported for {path}; using buffered writes")
+    return os.open(path, flags, 0o644)
+
+
+def _disable_direct_io(fd: int) -> None:
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~O_DIRECT)
+
+
+def _write_all(fd: int, data: memoryview) -> None:
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError as e:
+            # Some filesystems accept O_DIRECT at open() but reject the writes
+            if e.errno != errno.EINVAL or not fcntl.fcntl(fd, fcntl.F_GETFL) & O_DIRECT:
+                raise
+            _disable_direct_io(fd)
+            continue
+        data = data[written:]
+
+
+async def _pump_and_count(
+    read_fd: int, out_fd: int, direct: bool = False, count: bool = True
+) -> Optional[int]:
+    """Copy a pipe to ``out_fd`` while counting SAM records on the fly.
+
+    Reads land in one of two preallocated buffers via ``readinto``. While one
+    buffer is written out on a worker thread the next read fills the other,
+    so disk writes neither block the event loop nor stall draining BWA.
+    With ``direct`` the buffers are only written once full, keeping every
+    O_DIRECT write aligned; the unaligned tail is written buffered.
+    Without ``count`` (e.g. for binary ``.sai`` output) only the copy is
+    done and None is returned.
+    """
+    loop = asyncio.get_running_loop()
+    size = DIRECT_IO_BUFFER if direct else SAM_PUMP_BUFFER
+    slots = []
+    for _ in range(2):
+        buf, base = _aligned_buffer(size)
+        slots.append((buf, base, memoryview(buf)[base:base + size]))
+    current = 0
+    pending = None
+    records = 0
+    at_line_start = True
+    os.set_blocking(read_fd, False)
+    with open(read_fd, 'rb', buffering=0, closefd=False) as pipe:
+        try:
+            eof = False
+            while not eof:
+                buf, base, view = slots[current]
+                filled = 0
+                while filled < size:
+                    n = pipe.readinto(view[filled:])
+                    if n is None:
+                        if filled and not direct:
+                            break
+                        await _wait_readable(read_fd)
+                        continue
+                    if n == 0:
+                        eof = True
+                        break
+                    filled += n
+                
+                if filled and count:
+                    records += _count_sam_records(buf, at_line_start, base, base + filled)
+                    at_line_start = buf[base + filled - 1] == ord("\n")
+                if filled:
+                    if pending is not None:
+                        await pending
+                    if direct and eof:
+                        _disable_direct_io(out_fd)
+                    pending = loop.run_in_executor(None, _write_all, out_fd, view[:filled])
+                    current ^= 1
+        finally:
+            # The caller closes out_fd as soon as we return
+            if pending is not None:
+                await pending
+    return records if count else None
+
 
 class ServerSettings(BaseSettings):
     max_file_size: int = 50_000_000_000  # 50GB for large FASTQ files
     temp_dir: Optional[str] = None
+    # Where each run's output directory is created; outputs are kept after
+    # the tool call returns. Falls back to temp_dir, then the system temp dir.
+    output_dir: Optional[str] = None
     timeout: int = 3600  # 1 hour for alignment
     bwa_path: str = "bwa"
+    samtools_path: str = "samtools"
+    # BWA stops scaling past roughly these thread counts; extra threads
+    # mostly add contention, so auto-detected counts are capped here.
+    max_mem_threads: int = 32
+    max_aln_threads: int = 16
+    # Write SAM/SAI output with O_DIRECT so huge files bypass the page cache
+    direct_io: bool = False
+    # Load each bwa_mem reference index into shared memory once with `bwa shm`
+    # so later runs skip reading it from disk. BWA keys these indexes by file
+    # name only. On exit `bwa shm -d` drops every index on the host, so it is
+    # only run if this server created the shared-memory segment.
+    use_shm: bool = False
     
     class Config:
         env_prefix = "BIO_MCP_"
 
 
+# Built once at import; list_tools is called on every client handshake
+_TOOLS = [
+    Tool(
+        name="bwa_index",
+        description="Create BWA index for reference genome",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "reference_fasta": {
+                    "type": "string",
+                    "description": "Path to reference FASTA file"
+                },
+                "algorithm": {
+                    "type": "string",
+                    "enum": ["bwtsw", "is"],
+                    "default": "bwtsw",
+                    "description": "Indexing algorithm (bwtsw for >2GB genomes)"
+                }
+            },
+            "required": ["reference_fasta"]
+        }
+    ),
+    Tool(
+        name="bwa_mem",
+        description="Align reads using BWA-MEM algorithm",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "reference": {
+                    "type": "string",
+                    "description": "Path to indexed reference genome"
+                },
+                "reads1": {
+                    "type": "string",
+                    "description": "Path to first reads file (FASTQ)"
+                },
+                "reads2": {
+                    "type": "string",
+                    "description": "Path to second reads file for paired-end"
+                },
+                "reads1_cmd": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "minItems": 1,
+                    "description": "Command streaming read 1 FASTQ to stdout instead of reads1 (e.g., ['samtools', 'fastq', '-1', '/dev/stdout', 'in.bam'])"
+                },
+                "reads2_cmd": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "minItems": 1,
+                    "description": "Command streaming read 2 FASTQ to stdout instead of reads2"
+                },
+                "threads": {
+                    "type": "integer",
+                    "description": "Number of threads (default: usable CPUs, capped at the server's max_mem_threads)"
+                },
+                "min_seed_length": {
+                    "type": "integer",
+                    "default": 19,
+                    "description": "Minimum seed length"
+                },
+                "band_width": {
+                    "type": "integer",
+                    "default": 100,
+                    "description": "Band width for banded alignment"
+                },
+                "chunk_size": {
+                    "type": "integer",
+                    "default": 10000000,
+                    "description": "Input bases processed per batch (-K); fixed size keeps output deterministic across thread counts"
+                },
+                "cpu_list": {
+                    "type": "string",
+                    "description": "CPU list to pin BWA to with taskset (e.g., '0-15' for one NUMA node)"
+                },
+                "read_group": {
+                    "type": "string",
+                    "description": "Read group header line (e.g., '@RG\\tID:sample1\\tSM:sample1')"
+                },
+                "count_records": {
+                    "type": "boolean",
+                    "default": False,
+                    "description": "Count alignment records in the output SAM"
+                },
+                "output_format": {
+                    "type": "string",
+                    "enum": ["sam", "bam"],
+                    "default": "sam",
+                    "description": "Write SAM, or BAM compressed on the fly by samtools"
+                }
+            },
+            "required": ["reference"],
+            "anyOf": [{"required": ["reads1"]}, {"required": ["reads1_cmd"]}]
+        }
+    ),
+    Tool(
+        name="bwa_aln",
+        description="Find SA coordinates with BWA-backtrack algorithm (one or both mates of a pair)",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "reference": {
+                    "type": "string",
+                    "description": "Path to indexed reference genome"
+                },
+                "reads": {
+                    "type": "string",
+                    "description": "Path to reads file (FASTQ)"
+                },
+                "reads2": {
+                    "type": "string",
+                    "description": "Path to mate reads file; both files are aligned concurrently"
+                },
+                "threads": {
+                    "type": "integer",
+                    "description": "Number of threads (default: usable CPUs, capped at the server's max_aln_threads)"
+                },
+                "max_mismatches": {
+                    "type": "integer",
+                    "default": 4,
+                    "description": "Maximum number of mismatches"
+                },
+                "max_gap_opens": {
+                    "type": "integer",
+                    "default": 1,
+                    "description": "Maximum number of gap opens"
+                }
+            },
+            "required": ["reference", "reads"]
+        }
+    ),
+    Tool(
+        name="bwa_samse",
+        description="Generate alignments in SAM format (single-end)",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "reference": {
+                    "type": "string",
+                    "description": "Path to indexed reference genome"
+                },
+                "sai_file": {
+                    "type": "string",
+                    "description": "Path to .sai file from bwa aln"
+                },
+                "reads": {
+                    "type": "string",
+                    "description": "Path to original reads file"
+                },
+                "sort": {
+                    "type": "boolean",
+                    "default": False,
+                    "description": "Pipe output through samtools sort and write a coordinate-sorted BAM"
+                },
+                "threads": {
+                    "type": "integer",
+                    "default": 4,
+                    "description": "Number of samtools sort threads"
+                },
+                "count_records": {
+                    "type": "boolean",
+                    "default": False,
+                    "description": "Count alignment records in the output SAM"
+                }
+            },
+            "required": ["reference", "sai_file", "reads"]
+        }
+    ),
+    Tool(
+        name="bwa_sampe",
+        description="Generate alignments in SAM format (paired-end)",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "reference": {
+                    "type": "string",
+                    "description": "Path to indexed reference genome"
+                },
+                "sai_file1": {
+                    "type": "string",
+                    "description": "Path to .sai file for read 1"
+                },
+                "sai_file2": {
+                    "type": "string",
+                    "description": "Path to .sai file for read 2"
+                },
+                "reads1": {
+                    "type": "string",
+                    "description": "Path to reads file 1"
+                },
+                "reads2": {
+                    "type": "string",
+                    "description": "Path to reads file 2"
+                },
+                "sort": {
+                    "type": "boolean",
+                    "default": False,
+                    "description": "Pipe output through samtools sort and write a coordinate-sorted BAM"
+                },
+                "threads": {
+                    "type": "integer",
+                    "default": 4,
+                    "description": "Number of samtools sort threads"
+                },
+                "count_records": {
+                    "type": "boolean",
+                    "default": False,
+                    "description": "Count alignment records in the output SAM"
+                }
+            },
+            "required": ["reference", "sai_file1", "sai_file2", "reads1", "reads2"]
+        }
+    ),
+]
+
+
+@lru_cache(maxsize=1)
+def _default_settings() -> ServerSettings:
+    return ServerSettings()
+
+
 class BwaServer:
     def __init__(self, settings: Optional[ServerSettings] = None):
-        self.settings = settings or ServerSettings()
+        self.settings = settings or _default_settings()
         self.server = Server("bio-mcp-bwa")
+        # Reference basename -> path of the index loaded under that name
+        self._shm_indexes: dict[str, str] = {}
+        self._owns_shm = False
+        self._shm_lock = asyncio.Lock()
         self._setup_handlers()
         
     def _setup_handlers(self):
         @self.server.list_tools()
         async def list_tools() -> list[Tool]:
-            return [
-                Tool(
-                    name="bwa_index",
-                    description="Create BWA index for reference genome",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "reference_fasta": {
-                                "type": "string",
-                                "description": "Path to reference FASTA file"
-                            },
-                            "algorithm": {
-                                "type": "string",
-                                "enum": ["bwtsw", "is"],
-                                "default": "bwtsw",
-                                "description": "Indexing algorithm (bwtsw for >2GB genomes)"
-                            }
-                        },
-                        "required": ["reference_fasta"]
-                    }
-                ),
-                Tool(
-                    name="bwa_mem",
-                    description="Align reads using BWA-MEM algorithm",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "reference": {
-                                "type": "string",
-                                "description": "Path to indexed reference genome"
-                            },
-                            "reads1": {
-                                "type": "string",
-                                "description": "Path to first reads file (FASTQ)"
-                            },
-                            "reads2": {
-                                "type": "string",
-                                "description": "Path to second reads file for paired-end"
-                            },
-                            "threads": {
-                                "type": "integer",
-                                "default": 4,
-                                "description": "Number of threads"
-                            },
-                            "min_seed_length": {
-                                "type": "integer",
-                                "default": 19,
-                                "description": "Minimum seed length"
-                            },
-                            "band_width": {
-                                "type": "integer",
-                                "default": 100,
-                                "description": "Band width for banded alignment"
-                            },
-                            "read_group": {
-                                "type": "string",
-                                "description": "Read group header line (e.g., '@RG\\tID:sample1\\tSM:sample1')"
-                            }
-                        },
-                        "required": ["reference", "reads1"]
-                    }
-                ),
-                Tool(
-                    name="bwa_aln",
-                    description="Find SA coordinates with BWA-backtrack algorithm",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "reference": {
-                                "type": "string",
-                                "description": "Path to indexed reference genome"
-                            },
-                            "reads": {
-                                "type": "string",
-                                "description": "Path to reads file (FASTQ)"
-                            },
-                            "threads": {
-                                "type": "integer",
-                                "default": 4
-                            },
-                            "max_mismatches": {
-                                "type": "integer",
-                                "default": 4,
-                                "description": "Maximum number of mismatches"
-                            },
-                            "max_gap_opens": {
-                                "type": "integer",
-                                "default": 1,
-                                "description": "Maximum number of gap opens"
-                            }
-                        },
-                        "required": ["reference", "reads"]
-                    }
-                ),
-                Tool(
-                    name="bwa_samse",
-                    description="Generate alignments in SAM format (single-end)",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "reference": {
-                                "type": "string",
-                                "description": "Path to indexed reference genome"
-                            },
-                            "sai_file": {
-                                "type": "string",
-                                "description": "Path to .sai file from bwa aln"
-                            },
-                            "reads": {
-                                "type": "string",
-                                "description": "Path to original reads file"
-                            }
-                        },
-                        "required": ["reference", "sai_file", "reads"]
-                    }
-                ),
-                Tool(
-                    name="bwa_sampe",
-                    description="Generate alignments in SAM format (paired-end)",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "reference": {
-                                "type": "string",
-                                "description": "Path to indexed reference genome"
-                            },
-                            "sai_file1": {
-                                "type": "string",
-                                "description": "Path to .sai file for read 1"
-                            },
-                            "sai_file2": {
-                                "type": "string",
-                                "description": "Path to .sai file for read 2"
-                            },
-                            "reads1": {
-                                "type": "string",
-                                "description": "Path to reads file 1"
-                            },
-                            "reads2": {
-                                "type": "string",
-                                "description": "Path to reads file 2"
-                            }
-                        },
-                        "required": ["reference", "sai_file1", "sai_file2", "reads1", "reads2"]
-                    }
-                ),
-            ]
+            return _TOOLS
         
         @self.server.call_tool()
         async def call_tool(name: str, arguments: Any) -> list[TextContent | ErrorContent]:
@@ -195,26 +520,322 @@ class BwaServer:
             else:
                 return [ErrorContent(text=f"Unknown tool: {name}")]
     
+    async def _bwa_shm(self, *args: str) -> tuple[int, bytes, bytes]:
+        process = await asyncio.create_subprocess_exec(
+            self.settings.bwa_path, "shm", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await asyncio.wait_for(
+            process.communicate(),
+            timeout=self.settings.timeout
+        )
+        return process.returncode, stdout, stderr
+    
+    async def _ensure_shm_index(self, reference: Path) -> Optional[str]:
+        """Load ``reference``'s index into shared memory unless already loaded.
+        
+        BWA finds shared-memory indexes by the prefix's basename alone, so
+        ``bwa mem`` would silently align against any loaded index sharing the
+        reference's file name, whether this server or another process loaded
+        it. That case is refused with an error message; None means ``bwa mem``
+        may go ahead.
+        """
+        async with self._shm_lock:
+            loaded = self._shm_indexes.get(reference.name)
+            if loaded == str(reference):
+                return None
+            if loaded is not None:
+                return self._shm_clash(reference, loaded)
+            
+            # `bwa shm -l` prints one "name<TAB>size" line per loaded index
+            returncode, stdout, _ = await self._bwa_shm("-l")
+            listed = {
+                line.split("\t")[0] for line in stdout.decode().splitlines() if line.strip()
+            } if returncode == 0 else set()
+            if not self._shm_indexes:
+                # No indexes means no segment exists yet, so ours is safe to drop
+                self._owns_shm = returncode == 0 and not listed
+            if reference.name in listed:
+                return self._shm_clash(reference, "another process")
+            
+            returncode, _, stderr = await self._bwa_shm(str(reference))
+            
+            if returncode != 0:
+                # Another process may have loaded the same name since the listing
+                if b"already in shared memory" in stderr:
+                    return self._shm_clash(reference, "another process")
+                # Not fatal: nothing by this name is loaded, so bwa mem reads the index from disk
+                logger.warning(f"bwa shm failed for {reference}: {stderr.decode()}")
+                return None
+            self._shm_indexes[reference.name] = str(reference)
+            return None
+    
+    def _shm_clash(self, reference: Path, source: str) -> str:
+        logger.warning(
+            f"Not loading {reference} into shared memory: an index named "
+            f"{reference.name} is already loaded from {source}"
+        )
+        return (
+            f"An index named {reference.name} is already in shared memory "
+            f"(from {source}), and bwa mem would align against it; "
+            f"rename the reference or run without shared memory"
+        )
+    
+    async def _drop_shm_indexes(self) -> None:
+        if not self._shm_indexes:
+            return
+        # `bwa shm -d` drops every index on the host, not just ours
+        if self._owns_shm:
+            returncode, _, stderr = await self._bwa_shm("-d")
+            if returncode != 0:
+                logger.warning(f"bwa shm -d failed: {stderr.decode()}")
+        else:
+            logger.info("Leaving shared-memory indexes in place: the segment predates this server")
+        self._shm_indexes.clear()
+        self._owns_shm = False
+    
+    def _make_output_dir(self) -> Path:
+        """Create a fresh directory for one run's output files."""
+        root = self.settings.output_dir or self.settings.temp_dir or tempfile.gettempdir()
+        out_dir = Path(root) / f"bwa-{uuid4().hex}"
+        out_dir.mkdir(parents=True)
+        return out_dir
+    
+    def _resolve_threads(self, arguments: dict, limit: int, tool: str, jobs: int = 1) -> int:
+        """Return the requested thread count, or a share of the usable CPUs capped at ``limit``.
+        
+        ``jobs`` is the number of processes that will run concurrently and
+        split the machine between them.
+        """
+        threads = arguments.get("threads")
+        if not threads:
+            cpus = _available_cpus(arguments.get("cpu_list"))
+            return min(max(cpus // jobs, 1), limit)
+        if threads > limit:
+            logger.warning(
+                f"{tool}: {threads} threads requested; throughput usually stops "
+                f"improving past {limit}"
+            )
+        return threads
+    
+    async def _spawn_producer(
+        self, producer_cmd: list[str]
+    ) -> tuple[asyncio.subprocess.Process, asyncio.Task, int]:
+        """Start ``producer_cmd`` writing into a pipe.
+        
+        Returns the process, a task draining its stderr and the pipe's read end.
+        BWA reads the pipe as ``/dev/fd/N``, the same mechanism bash uses for
+        ``<(...)``, so streamed FASTQ never has to be materialised on disk.
+        The stderr drain starts at once: a chatty producer must not block on a
+        full stderr pipe while BWA waits for its reads.
+        """
+        read_fd, write_fd = _make_pipe()
+        try:
+            producer = await asyncio.create_subprocess_exec(
+                *producer_cmd,
+                stdout=write_fd,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except Exception:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        stderr_task = asyncio.ensure_future(_read_stderr_tail(producer.stderr))
+        return producer, stderr_task, read_fd
+    
+    async def _finish_producers(
+        self, producers: list[tuple[asyncio.subprocess.Process, asyncio.Task]]
+    ) -> Optional[str]:
+        """Wait for read producers; describe the first one that failed, if any."""
+        results = await asyncio.wait_for(
+            asyncio.gather(
+                *(stderr_task for _, stderr_task in producers),
+                *(producer.wait() for producer, _ in producers)
+            ),
+            timeout=self.settings.timeout
+        )
+        # zip() stops after the stderr results; the wait() results follow them
+        for (producer, _), stderr in zip(producers, results):
+            if producer.returncode != 0:
+                return f"exit status {producer.returncode}: {stderr.decode()}"
+        return None
+    
+    async def _kill_producers(
+        self, producers: list[tuple[asyncio.subprocess.Process, asyncio.Task]]
+    ) -> None:
+        """Kill read producers that are still running and reap them."""
+        for producer, stderr_task in producers:
+            if producer.returncode is None:
+                producer.kill()
+            await producer.wait()
+            # The drain ends at EOF once the producer is gone
+            await asyncio.gather(stderr_task, return_exceptions=True)
+    
+    async def _count_records(self, bam_file: Path) -> int:
+        """Count BAM records with ``samtools view -c``, outside the event loop.
+        
+        SAM output never needs this: it is counted while being written.
+        """
+        process = await asyncio.create_subprocess_exec(
+            self.settings.samtools_path, "view", "-c", str(bam_file),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        
+        stdout, stderr = await asyncio.wait_for(
+            process.communicate(),
+            timeout=self.settings.timeout
+        )
+        
+        if process.returncode != 0:
+            raise RuntimeError(f"Record count failed: {stderr.decode()}")
+        return int(stdout)
+    
+    async def _wait_or_kill(self, processes: list[asyncio.subprocess.Process], *aws) -> list:
+        """Gather ``aws`` within the timeout, killing ``processes`` if that fails.
+        
+        Otherwise a timed-out BWA would keep writing into an output directory
+        the caller has already given up on.
+        """
+        try:
+            return await asyncio.wait_for(asyncio.gather(*aws), timeout=self.settings.timeout)
+        except BaseException as e:
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+            if isinstance(e, asyncio.TimeoutError):
+                raise RuntimeError(f"Timed out after {self.settings.timeout} seconds") from e
+            raise
+    
+    async def _run_to_file(
+        self,
+        cmd: list[str],
+        output_file: Path,
+        count_records: bool = False,
+        pass_fds: tuple[int, ...] = ()
+    ) -> tuple[int, bytes, Optional[int]]:
+        """Run ``cmd`` with its stdout written to ``output_file``.
+        
+        BWA writes the file itself unless records are counted or direct I/O is
+        enabled, in which case its output is pumped through our own buffers.
+        Returns the exit status, stderr and record count (None if not counted).
+        """
+        direct = self.settings.direct_io and bool(O_DIRECT)
+        fd = _open_output(output_file, direct)
+        if not count_records and not direct:
+            # Let BWA write the file itself; nothing passes through Python
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=fd,
+                    stderr=asyncio.subprocess.PIPE,
+                    pass_fds=pass_fds
+                )
+            finally:
+                # The child has its own copy
+                os.close(fd)
+            
+            stderr, _ = await self._wait_or_kill(
+                [process],
+                _read_stderr_tail(process.stderr),
+                process.wait()
+            )
+            return process.returncode, stderr, None
+        
+        try:
+            read_fd, write_fd = _make_pipe()
+            try:
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        *cmd,
+                        stdout=write_fd,
+                        stderr=asyncio.subprocess.PIPE,
+                        pass_fds=pass_fds
+                    )
+                finally:
+                    os.close(write_fd)
+                
+                records, stderr, _ = await self._wait_or_kill(
+                    [process],
+                    _pump_and_count(read_fd, fd, direct, count=count_records),
+                    _read_stderr_tail(process.stderr),
+                    process.wait()
+                )
+            finally:
+                os.close(read_fd)
+            return process.returncode, stderr, records
+        finally:
+            os.close(fd)
+    
+    async def _run_piped(
+        self,
+        cmd: list[str],
+        downstream: list[str],
+        pass_fds: tuple[int, ...] = ()
+    ) -> tuple[int, bytes]:
+        """Run ``cmd`` with its stdout connected straight to ``downstream``'s stdin.
+        
+        Returns the first non-zero exit status of the two (0 on success) and
+        their combined stderr.
+        """
+        read_fd, write_fd = _make_pipe()
+        try:
+            upstream = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=write_fd,
+                stderr=asyncio.subprocess.PIPE,
+                pass_fds=pass_fds
+            )
+            try:
+                consumer = await asyncio.create_subprocess_exec(
+                    *downstream,
+                    stdin=read_fd,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            except Exception:
+                upstream.kill()
+                await upstream.wait()
+                raise
+        finally:
+            # Both children hold their own copies; closing ours lets EOF propagate
+            os.close(read_fd)
+            os.close(write_fd)
+        
+        upstream_stderr, consumer_stderr, _, _ = await self._wait_or_kill(
+            [upstream, consumer],
+            _read_stderr_tail(upstream.stderr),
+            _read_stderr_tail(consumer.stderr),
+            upstream.wait(),
+            consumer.wait()
+        )
+        
+        returncode = upstream.returncode or consumer.returncode
+        return returncode, upstream_stderr + consumer_stderr
+    
     async def _run_index(self, arguments: dict) -> list[TextContent | ErrorContent]:
         try:
             reference_fasta = Path(arguments["reference_fasta"])
-            if not reference_fasta.exists():
+            reference_stat = _stat(reference_fasta)
+            if reference_stat is None:
                 return [ErrorContent(text=f"Reference file not found: {reference_fasta}")]
             
             # Check file size for algorithm choice
-            file_size = reference_fasta.stat().st_size
+            file_size = reference_stat.st_size
             algorithm = arguments.get("algorithm", "bwtsw" if file_size > 2_000_000_000 else "is")
             
             cmd = [self.settings.bwa_path, "index", "-a", algorithm, str(reference_fasta)]
             
             process = await asyncio.create_subprocess_exec(
                 *cmd,
-                stdout=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
                 stderr=asyncio.subprocess.PIPE
             )
             
-            stdout, stderr = await asyncio.wait_for(
-                process.communicate(),
+            stderr, _ = await asyncio.wait_for(
+                asyncio.gather(_read_stderr_tail(process.stderr), process.wait()),
                 timeout=self.settings.timeout
             )
             
@@ -223,9 +844,9 @@ class BwaServer:
             
             # List created index files
             index_files = []
-            for suffix in ['.amb', '.ann', '.bwt', '.pac', '.sa']:
+            for suffix in BWA_INDEX_SUFFIXES:
                 index_file = reference_fasta.with_suffix(reference_fasta.suffix + suffix)
-                if index_file.exists():
+                if _stat(index_file) is not None:
                     index_files.append(str(index_file))
             
             return [TextContent(
@@ -240,172 +861,292 @@ class BwaServer:
             return [ErrorContent(text=f"Error: {str(e)}")]
     
     async def _run_mem(self, arguments: dict) -> list[TextContent | ErrorContent]:
+        out_dir = None
         try:
             reference = Path(arguments["reference"])
-            reads1 = Path(arguments["reads1"])
+            if not arguments.get("reads1") and not arguments.get("reads1_cmd"):
+                return [ErrorContent(text="Either reads1 or reads1_cmd is required")]
+            for key in ("reads1_cmd", "reads2_cmd"):
+                producer_cmd = arguments.get(key)
+                if producer_cmd is not None and not (
+                    isinstance(producer_cmd, list) and producer_cmd
+                    and all(isinstance(arg, str) for arg in producer_cmd)
+                ):
+                    return [ErrorContent(
+                        text=f"{key} must be a non-empty list of strings, "
+                             f"e.g. [\"samtools\", \"fastq\", \"in.bam\"]"
+                    )]
             
-            if not reference.exists():
+            # Stat every input once up front
+            reads_paths = {
+                key: Path(arguments[key]) for key in ("reads1", "reads2")
+                if arguments.get(key) and not arguments.get(f"{key}_cmd")
+            }
+            stats = {path: _stat(path) for path in [reference, *reads_paths.values()]}
+            
+            if stats[reference] is None:
                 return [ErrorContent(text=f"Reference not found: {reference}")]
-            if not reads1.exists():
-                return [ErrorContent(text=f"Reads file not found: {reads1}")]
+            missing = _missing_index_files(reference)
+            if missing:
+                return [ErrorContent(text=f"Missing index files for {reference}: {', '.join(missing)}")]
+            if "reads1" in reads_paths and stats[reads_paths["reads1"]] is None:
+                return [ErrorContent(text=f"Reads file not found: {reads_paths['reads1']}")]
             
-            with tempfile.TemporaryDirectory(dir=self.settings.temp_dir) as tmpdir:
-                output_sam = Path(tmpdir) / "alignment.sam"
-                
-                cmd = [
-                    self.settings.bwa_path, "mem",
-                    "-t", str(arguments.get("threads", 4)),
-                    "-k", str(arguments.get("min_seed_length", 19)),
-                    "-w", str(arguments.get("band_width", 100))
-                ]
-                
-                # Add read group if provided
-                if arguments.get("read_group"):
-                    cmd.extend(["-R", arguments["read_group"]])
-                
-                cmd.append(str(reference))
-                cmd.append(str(reads1))
-                
-                # Add second reads file if paired-end
-                if arguments.get("reads2"):
-                    reads2 = Path(arguments["reads2"])
-                    if reads2.exists():
-                        cmd.append(str(reads2))
-                
-                # Redirect output to file
-                with open(output_sam, 'w') as f:
-                    process = await asyncio.create_subprocess_exec(
-                        *cmd,
-                        stdout=f,
-                        stderr=asyncio.subprocess.PIPE
-                    )
+            output_format = arguments.get("output_format", "sam")
+            if output_format not in ("sam", "bam"):
+                return [ErrorContent(text=f"Unsupported output format: {output_format}")]
+            
+            threads = self._resolve_threads(arguments, self.settings.max_mem_threads, "bwa mem")
+            
+            if self.settings.use_shm:
+                shm_error = await self._ensure_shm_index(reference)
+                if shm_error is not None:
+                    return [ErrorContent(text=shm_error)]
+            
+            out_dir = self._make_output_dir()
+            output_sam = out_dir / f"alignment.{output_format}"
+            
+            cmd = [
+                self.settings.bwa_path, "mem",
+                "-t", str(threads),
+                "-k", str(arguments.get("min_seed_length", 19)),
+                "-w", str(arguments.get("band_width", 100)),
+                "-K", str(arguments.get("chunk_size", 10_000_000))
+            ]
+            
+            # Pin BWA to a CPU set, e.g. a single NUMA node
+            if arguments.get("cpu_list"):
+                cmd = ["taskset", "-c", arguments["cpu_list"]] + cmd
+            
+            # Add read group if provided
+            if arguments.get("read_group"):
+                cmd.extend(["-R", arguments["read_group"]])
+            
+            cmd.append(str(reference))
+            
+            # Reads come from files, or from producer commands streamed over pipes
+            producers = []
+            pass_fds = []
+            try:
+                try:
+                    for key in ("reads1", "reads2"):
+                        if arguments.get(f"{key}_cmd"):
+                            producer, stderr_task, read_fd = await self._spawn_producer(
+                                arguments[f"{key}_cmd"]
+                            )
+                            producers.append((producer, stderr_task))
+                            pass_fds.append(read_fd)
+                            cmd.append(f"/dev/fd/{read_fd}")
+                        elif key in reads_paths:
+                            reads = reads_paths[key]
+                            # Add second reads file if paired-end
+                            if key == "reads1" or stats[reads] is not None:
+                                cmd.append(str(reads))
                     
-                    _, stderr = await asyncio.wait_for(
-                        process.communicate(),
-                        timeout=self.settings.timeout
-                    )
+                    if output_format == "bam":
+                        # Compress on the fly: bwa mem | samtools view -b -1
+                        returncode, stderr = await self._run_piped(
+                            cmd,
+                            [self.settings.samtools_path, "view", "-b", "-1", "-o", str(output_sam), "-"],
+                            pass_fds=tuple(pass_fds)
+                        )
+                        total_lines = None
+                    else:
+                        returncode, stderr, total_lines = await self._run_to_file(
+                            cmd,
+                            output_sam,
+                            count_records=arguments.get("count_records", False),
+                            pass_fds=tuple(pass_fds)
+                        )
+                finally:
+                    # Once our read ends are closed, producers see EPIPE if BWA stopped early
+                    for read_fd in pass_fds:
+                        os.close(read_fd)
                 
-                if process.returncode != 0:
+                if returncode != 0:
+                    await self._kill_producers(producers)
+                    shutil.rmtree(out_dir, ignore_errors=True)
                     return [ErrorContent(text=f"BWA mem failed: {stderr.decode()}")]
                 
-                # Get alignment statistics
-                output_size = output_sam.stat().st_size
-                
-                # Count alignments quickly
-                with open(output_sam) as f:
-                    total_lines = sum(1 for line in f if not line.startswith('@'))
-                
-                return [TextContent(
-                    text=f"BWA-MEM alignment completed!\n\n"
-                         f"Output file: {output_sam}\n"
-                         f"Output size: {output_size:,} bytes\n"
-                         f"Alignment records: {total_lines:,}\n"
-                         f"Threads used: {arguments.get('threads', 4)}\n"
-                         f"Paired-end: {'Yes' if arguments.get('reads2') else 'No'}"
-                )]
+                # BAM output is counted once samtools has finished writing it
+                if output_format == "bam" and arguments.get("count_records"):
+                    total_lines = await self._count_records(output_sam)
                 
+                producer_error = await self._finish_producers(producers)
+            except BaseException:
+                await self._kill_producers(producers)
+                raise
+            if producer_error is not None:
+                shutil.rmtree(out_dir, ignore_errors=True)
+                return [ErrorContent(text=f"Reads command failed: {producer_error}")]
+            
+            # Get alignment statistics
+            output_size = output_sam.stat().st_size
+            
+            return [TextContent(
+                text=f"BWA-MEM alignment completed!\n\n"
+                     f"Output file: {output_sam}\n"
+                     f"Output format: {output_format.upper()}\n"
+                     f"Output size: {output_size:,} bytes\n"
+                     f"Alignment records: {_format_count(total_lines)}\n"
+                     f"Threads used: {threads}\n"
+                     f"Paired-end: {'Yes' if arguments.get('reads2') or arguments.get('reads2_cmd') else 'No'}"
+            )]
+            
         except Exception as e:
+            # Don't leave a partial, possibly huge, output behind
+            if out_dir is not None:
+                shutil.rmtree(out_dir, ignore_errors=True)
             logger.error(f"Error in BWA mem: {e}", exc_info=True)
             return [ErrorContent(text=f"Error: {str(e)}")]
     
     async def _run_aln(self, arguments: dict) -> list[TextContent | ErrorContent]:
+        out_dir = None
         try:
             reference = Path(arguments["reference"])
-            reads = Path(arguments["reads"])
+            reads_files = [Path(arguments["reads"])]
+            if arguments.get("reads2"):
+                reads_files.append(Path(arguments["reads2"]))
+            
+            stats = {path: _stat(path) for path in [reference, *reads_files]}
             
-            if not reference.exists():
+            if stats[reference] is None:
                 return [ErrorContent(text=f"Reference not found: {reference}")]
-            if not reads.exists():
-                return [ErrorContent(text=f"Reads file not found: {reads}")]
+            missing = _missing_index_files(reference)
+            if missing:
+                return [ErrorContent(text=f"Missing index files for {reference}: {', '.join(missing)}")]
+            for reads in reads_files:
+                if stats[reads] is None:
+                    return [ErrorContent(text=f"Reads file not found: {reads}")]
             
-            with tempfile.TemporaryDirectory(dir=self.settings.temp_dir) as tmpdir:
-                output_sai = Path(tmpdir) / "alignment.sai"
-                
-                cmd = [
+            threads = self._resolve_threads(
+                arguments, self.settings.max_aln_threads, "bwa aln", jobs=len(reads_files)
+            )
+            
+            out_dir = self._make_output_dir()
+            if len(reads_files) == 1:
+                output_sais = [out_dir / "alignment.sai"]
+            else:
+                output_sais = [out_dir / "alignment_1.sai", out_dir / "alignment_2.sai"]
+            
+            cmds = [
+                [
                     self.settings.bwa_path, "aln",
-                    "-t", str(arguments.get("threads", 4)),
+                    "-t", str(threads),
                     "-n", str(arguments.get("max_mismatches", 4)),
                     "-o", str(arguments.get("max_gap_opens", 1)),
                     str(reference),
                     str(reads)
                 ]
-                
-                with open(output_sai, 'wb') as f:
-                    process = await asyncio.create_subprocess_exec(
-                        *cmd,
-                        stdout=f,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    
-                    _, stderr = await asyncio.wait_for(
-                        process.communicate(),
-                        timeout=self.settings.timeout
-                    )
-                
-                if process.returncode != 0:
+                for reads in reads_files
+            ]
+            
+            # Paired-end mates are independent, so both run at once
+            runs = [
+                asyncio.ensure_future(self._run_to_file(cmd, output_sai))
+                for cmd, output_sai in zip(cmds, output_sais)
+            ]
+            try:
+                results = await asyncio.gather(*runs)
+            except BaseException:
+                # Cancelling the other mate's run kills its BWA
+                for run in runs:
+                    run.cancel()
+                await asyncio.gather(*runs, return_exceptions=True)
+                raise
+            
+            for returncode, stderr, _ in results:
+                if returncode != 0:
+                    shutil.rmtree(out_dir, ignore_errors=True)
                     return [ErrorContent(text=f"BWA aln failed: {stderr.decode()}")]
-                
-                output_size = output_sai.stat().st_size
-                
-                return [TextContent(
-                    text=f"BWA aln completed!\n\n"
-                         f"Output SAI file: {output_sai}\n"
-                         f"Output size: {output_size:,} bytes\n"
-                         f"Use bwa_samse/sampe to convert to SAM format"
-                )]
-                
+            
+            output_lines = "".join(
+                f"Output SAI file: {output_sai}\n"
+                f"Output size: {output_sai.stat().st_size:,} bytes\n"
+                for output_sai in output_sais
+            )
+            
+            return [TextContent(
+                text=f"BWA aln completed!\n\n"
+                     f"{output_lines}"
+                     f"Threads used: {threads}"
+                     f"{' per read file' if len(reads_files) > 1 else ''}\n"
+                     f"Use bwa_samse/sampe to convert to SAM format"
+            )]
+            
         except Exception as e:
+            if out_dir is not None:
+                shutil.rmtree(out_dir, ignore_errors=True)
             logger.error(f"Error in BWA aln: {e}", exc_info=True)
             return [ErrorContent(text=f"Error: {str(e)}")]
     
     async def _run_samse(self, arguments: dict) -> list[TextContent | ErrorContent]:
+        out_dir = None
         try:
             reference = Path(arguments["reference"])
             sai_file = Path(arguments["sai_file"])
             reads = Path(arguments["reads"])
             
             for file_path in [reference, sai_file, reads]:
-                if not file_path.exists():
+                if _stat(file_path) is None:
                     return [ErrorContent(text=f"File not found: {file_path}")]
+            missing = _missing_index_files(reference)
+            if missing:
+                return [ErrorContent(text=f"Missing index files for {reference}: {', '.join(missing)}")]
+            
+            sort = arguments.get("sort", False)
+            out_dir = self._make_output_dir()
+            output_sam = out_dir / ("alignment.bam" if sort else "alignment.sam")
+            
+            cmd = [
+                self.settings.bwa_path, "samse",
+                str(reference),
+                str(sai_file),
+                str(reads)
+            ]
+            
+            if sort:
+                # Sort as BWA streams: bwa samse | samtools sort
+                returncode, stderr = await self._run_piped(
+                    cmd,
+                    [
+                        self.settings.samtools_path, "sort",
+                        "-@", str(arguments.get("threads", 4)),
+                        "-o", str(output_sam), "-"
+                    ]
+                )
+                total_lines = None
+            else:
+                returncode, stderr, total_lines = await self._run_to_file(
+                    cmd,
+                    output_sam,
+                    count_records=arguments.get("count_records", False)
+                )
+            
+            if returncode != 0:
+                shutil.rmtree(out_dir, ignore_errors=True)
+                return [ErrorContent(text=f"BWA samse failed: {stderr.decode()}")]
+            
+            if sort and arguments.get("count_records"):
+                total_lines = await self._count_records(output_sam)
+            
+            output_size = output_sam.stat().st_size
+            
+            return [TextContent(
+                text=f"BWA samse completed!\n\n"
+                     f"Output {'sorted BAM' if sort else 'SAM'} file: {output_sam}\n"
+                     f"Output size: {output_size:,} bytes\n"
+                     f"Alignment records: {_format_count(total_lines)}"
+            )]
             
-            with tempfile.TemporaryDirectory(dir=self.settings.temp_dir) as tmpdir:
-                output_sam = Path(tmpdir) / "alignment.sam"
-                
-                cmd = [
-                    self.settings.bwa_path, "samse",
-                    str(reference),
-                    str(sai_file),
-                    str(reads)
-                ]
-                
-                with open(output_sam, 'w') as f:
-                    process = await asyncio.create_subprocess_exec(
-                        *cmd,
-                        stdout=f,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    
-                    _, stderr = await asyncio.wait_for(
-                        process.communicate(),
-                        timeout=self.settings.timeout
-                    )
-                
-                if process.returncode != 0:
-                    return [ErrorContent(text=f"BWA samse failed: {stderr.decode()}")]
-                
-                output_size = output_sam.stat().st_size
-                
-                return [TextContent(
-                    text=f"BWA samse completed!\n\n"
-                         f"Output SAM file: {output_sam}\n"
-                         f"Output size: {output_size:,} bytes"
-                )]
-                
         except Exception as e:
+            if out_dir is not None:
+                shutil.rmtree(out_dir, ignore_errors=True)
             logger.error(f"Error in BWA samse: {e}", exc_info=True)
             return [ErrorContent(text=f"Error: {str(e)}")]
     
     async def _run_sampe(self, arguments: dict) -> list[TextContent | ErrorContent]:
+        out_dir = None
         try:
             reference = Path(arguments["reference"])
             sai_file1 = Path(arguments["sai_file1"])
@@ -414,51 +1155,71 @@ class BwaServer:
             reads2 = Path(arguments["reads2"])
             
             for file_path in [reference, sai_file1, sai_file2, reads1, reads2]:
-                if not file_path.exists():
+                if _stat(file_path) is None:
                     return [ErrorContent(text=f"File not found: {file_path}")]
+            missing = _missing_index_files(reference)
+            if missing:
+                return [ErrorContent(text=f"Missing index files for {reference}: {', '.join(missing)}")]
+            
+            sort = arguments.get("sort", False)
+            out_dir = self._make_output_dir()
+            output_sam = out_dir / ("alignment.bam" if sort else "alignment.sam")
+            
+            cmd = [
+                self.settings.bwa_path, "sampe",
+                str(reference),
+                str(sai_file1),
+                str(sai_file2),
+                str(reads1),
+                str(reads2)
+            ]
+            
+            if sort:
+                # Sort as BWA streams: bwa sampe | samtools sort
+                returncode, stderr = await self._run_piped(
+                    cmd,
+                    [
+                        self.settings.samtools_path, "sort",
+                        "-@", str(arguments.get("threads", 4)),
+                        "-o", str(output_sam), "-"
+                    ]
+                )
+                total_lines = None
+            else:
+                returncode, stderr, total_lines = await self._run_to_file(
+                    cmd,
+                    output_sam,
+                    count_records=arguments.get("count_records", False)
+                )
+            
+            if returncode != 0:
+                shutil.rmtree(out_dir, ignore_errors=True)
+                return [ErrorContent(text=f"BWA sampe failed: {stderr.decode()}")]
+            
+            if sort and arguments.get("count_records"):
+                total_lines = await self._count_records(output_sam)
+            
+            output_size = output_sam.stat().st_size
+            
+            return [TextContent(
+                text=f"BWA sampe completed!\n\n"
+                     f"Output {'sorted BAM' if sort else 'SAM'} file: {output_sam}\n"
+                     f"Output size: {output_size:,} bytes\n"
+                     f"Alignment records: {_format_count(total_lines)}"
+            )]
             
-            with tempfile.TemporaryDirectory(dir=self.settings.temp_dir) as tmpdir:
-                output_sam = Path(tmpdir) / "alignment.sam"
-                
-                cmd = [
-                    self.settings.bwa_path, "sampe",
-                    str(reference),
-                    str(sai_file1),
-                    str(sai_file2),
-                    str(reads1),
-                    str(reads2)
-                ]
-                
-                with open(output_sam, 'w') as f:
-                    process = await asyncio.create_subprocess_exec(
-                        *cmd,
-                        stdout=f,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    
-                    _, stderr = await asyncio.wait_for(
-                        process.communicate(),
-                        timeout=self.settings.timeout
-                    )
-                
-                if process.returncode != 0:
-                    return [ErrorContent(text=f"BWA sampe failed: {stderr.decode()}")]
-                
-                output_size = output_sam.stat().st_size
-                
-                return [TextContent(
-                    text=f"BWA sampe completed!\n\n"
-                         f"Output SAM file: {output_sam}\n"
-                         f"Output size: {output_size:,} bytes"
-                )]
-                
         except Exception as e:
+            if out_dir is not None:
+                shutil.rmtree(out_dir, ignore_errors=True)
             logger.error(f"Error in BWA sampe: {e}", exc_info=True)
             return [ErrorContent(text=f"Error: {str(e)}")]
     
     async def run(self):
-        async with stdio_server() as (read_stream, write_stream):
-            await self.server.run(read_stream, write_stream)
+        try:
+            async with stdio_server() as (read_stream, write_stream):
+                await self.server.run(read_stream, write_stream)
+        finally:
+            await self._drop_shm_indexes()
 
 
 async def main():
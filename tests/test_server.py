@@ -0,0 +1,175 @@
+import os
+import stat
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from src.server import (
+    BWA_INDEX_SUFFIXES,
+    DIRECT_IO_ALIGN,
+    BwaServer,
+    ServerSettings,
+    _count_sam_records,
+    _make_pipe,
+    _open_output,
+    _pump_and_count,
+)
+
+HEADER = b"@HD\tVN:1.6\tSO:unsorted\n@SQ\tSN:chr1\tLN:1000\n@PG\tID:bwa\tPN:bwa\n"
+
+
+def _sam(records: int) -> bytes:
+    body = b"".join(
+        b"r%d\t0\tchr1\t%d\t60\t10M\t*\t0\t0\tACGTACGTAC\tIIIIIIIIII\n" % (i, i + 1)
+        for i in range(records)
+    )
+    return HEADER + body
+
+
+def _count_in_chunks(data: bytes, size: int) -> int:
+    """Count ``data`` the way the pump does, one ``size``-byte chunk at a time."""
+    records = 0
+    at_line_start = True
+    for start in range(0, len(data), size):
+        end = min(start + size, len(data))
+        records += _count_sam_records(data, at_line_start, start, end)
+        at_line_start = data[end - 1:end] == b"\n"
+    return records
+
+
+async def _pump(data: bytes, out_path: Path, direct: bool = False, count: bool = True):
+    read_fd, write_fd = _make_pipe()
+
+    def feed():
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(write_fd, view[:65536]):]
+        finally:
+            os.close(write_fd)
+
+    writer = threading.Thread(target=feed)
+    writer.start()
+    out_fd = _open_output(out_path, direct)
+    try:
+        return await _pump_and_count(read_fd, out_fd, direct, count=count)
+    finally:
+        os.close(out_fd)
+        os.close(read_fd)
+        writer.join()
+
+
+def test_count_sam_records_whole_buffer():
+    assert _count_sam_records(_sam(3), True) == 3
+    assert _count_sam_records(HEADER, True) == 0
+    assert _count_sam_records(b"", True) == 0
+
+
+def test_count_sam_records_header_split_across_chunks():
+    data = _sam(5)
+    # Every split point, including ones right before and after a header '@'
+    for split in range(1, len(data)):
+        first = _count_sam_records(data, True, 0, split)
+        second = _count_sam_records(data, data[split - 1:split] == b"\n", split)
+        assert first + second == 5, split
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 4096])
+def test_count_sam_records_small_chunks(size):
+    assert _count_in_chunks(_sam(40), size) == 40
+
+
+@pytest.mark.asyncio
+async def test_pump_empty_stream(tmp_path):
+    out = tmp_path / "empty.sam"
+    assert await _pump(b"", out) == 0
+    assert out.read_bytes() == b""
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("records", [0, 3, 70_000])
+async def test_pump_counts_and_copies(tmp_path, records):
+    data = _sam(records)
+    out = tmp_path / "alignment.sam"
+    assert await _pump(data, out) == records
+    assert out.read_bytes() == data
+
+
+@pytest.mark.asyncio
+async def test_pump_without_count(tmp_path):
+    data = os.urandom(100_000)
+    out = tmp_path / "alignment.sai"
+    assert await _pump(data, out, count=False) is None
+    assert out.read_bytes() == data
+
+
+@pytest.mark.asyncio
+async def test_pump_direct_unaligned_tail(tmp_path):
+    # Several full direct buffers' worth plus a tail that is not block aligned;
+    # filesystems without O_DIRECT (tmpfs) exercise the buffered fallback
+    data = _sam(400_000)
+    assert len(data) % DIRECT_IO_ALIGN
+    out = tmp_path / "alignment.sam"
+    assert await _pump(data, out, direct=True) == 400_000
+    assert out.read_bytes() == data
+
+
+def _fake_bwa(tmp_path: Path, body: str) -> str:
+    script = tmp_path / "bwa"
+    script.write_text(f"#!/bin/sh\n{body}\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return str(script)
+
+
+def _reference(tmp_path: Path) -> Path:
+    reference = tmp_path / "ref.fa"
+    reference.write_text(">chr1\nACGT\n")
+    for suffix in BWA_INDEX_SUFFIXES:
+        Path(f"{reference}{suffix}").touch()
+    return reference
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("count_records", [False, True])
+async def test_mem_timeout_kills_bwa_and_removes_output(tmp_path, count_records):
+    pid_file = tmp_path / "bwa.pid"
+    bwa = _fake_bwa(tmp_path, f"echo $$ > {pid_file}\nprintf '@HD\\tVN:1.6\\n'\nexec sleep 60")
+    reads = tmp_path / "reads.fq"
+    reads.write_text("@r\nACGT\n+\nIIII\n")
+    out_root = tmp_path / "out"
+    server = BwaServer(ServerSettings(bwa_path=bwa, output_dir=str(out_root), timeout=1))
+
+    started = time.monotonic()
+    result = await server._run_mem({
+        "reference": str(_reference(tmp_path)),
+        "reads1": str(reads),
+        "count_records": count_records,
+    })
+
+    assert time.monotonic() - started < 30
+    assert "Timed out" in result[0].text
+    assert list(out_root.iterdir()) == []
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+@pytest.mark.asyncio
+async def test_mem_counts_records(tmp_path):
+    sam = tmp_path / "canned.sam"
+    sam.write_bytes(_sam(1234))
+    bwa = _fake_bwa(tmp_path, f"cat {sam}")
+    reads = tmp_path / "reads.fq"
+    reads.write_text("@r\nACGT\n+\nIIII\n")
+    server = BwaServer(ServerSettings(bwa_path=bwa, output_dir=str(tmp_path / "out")))
+
+    result = await server._run_mem({
+        "reference": str(_reference(tmp_path)),
+        "reads1": str(reads),
+        "count_records": True,
+    })
+
+    assert "Alignment records: 1,234" in result[0].text
+    (out_dir,) = (tmp_path / "out").iterdir()
+    assert (out_dir / "alignment.sam").read_bytes() == sam.read_bytes()